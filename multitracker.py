@@ -1,9 +1,12 @@
 #!/usr/bin/python3 -O
 
 from argparse import ArgumentParser
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from math import log2
 import os
+import re
 import shlex
 from subprocess import run, DEVNULL
 import sys
@@ -12,52 +15,76 @@ def parse_cli():
 	parser = ArgumentParser(description="Make torrent files for multiple trackers")
 	parser.add_argument("--opt-piece-count", "-o", type=int, default=1536, metavar="N", help="Set the optimal number of pieces to N (default: 1536)")
 	parser.add_argument("--trackers", "-t", nargs="+", metavar="SECTION", help="Tracker section defined in ~/.torrentutils/trackers (default: all)")
+	parser.add_argument("--quiet", "-q", action="store_true", help="Do not print the mktorrent commands")
 	parser.add_argument("filename", nargs="+", help="Target file or directory")
 	return parser.parse_args()
 
 def get_size(filename):
+	return walk_size(filename) if os.path.isdir(filename) else os.stat(filename).st_size
+
+def walk_size(path):
+	# Same semantics as os.walk: symlinked directories are not descended into
 	size = 0
-	if os.path.isdir(filename):
-		for dirpath, dirnames, filenames in os.walk(filename):
-			for f in filenames:
-				size += os.stat(os.path.join(dirpath, f)).st_size
-	else:
-		size += os.stat(filename).st_size
+	with os.scandir(path) as entries:
+		for entry in entries:
+			if entry.is_dir():
+				if not entry.is_symlink():
+					size += walk_size(entry.path)
+			else:
+				size += entry.stat().st_size
 	return size
 
+ANNOUNCE_KEY = re.compile(r"^announce\.tier\.(\d+)\.url\.(\d+)$")
+
+def precompute_trackers(config, trackers):
+	result = {}
+	for tracker in trackers:
+		section = config[tracker]
+		tiers = defaultdict(dict)
+		for k, v in section.items():
+			m = ANNOUNCE_KEY.match(k)
+			if m:
+				tiers[int(m.group(1))][int(m.group(2))] = v
+		result[tracker] = {
+			"dht": section["dht"] != "disabled",
+			"tiers": [ [ tiers[tier][url] for url in sorted(tiers[tier]) ] for tier in sorted(tiers) ]
+		}
+	return result
+
 def main(args):
 	config = ConfigParser()
 	config.read(os.path.join(os.environ["HOME"], ".torrentutils", "trackers" ))
-	trackers = args.trackers or config.sections()
-	returncode = 0
+	trackers = precompute_trackers(config, args.trackers or config.sections())
+	cmds = []
 
 	for filename in args.filename:
 		size = get_size(filename)
 		os.umask(0o0266)
 		piece_size = str(round(log2(size / args.opt_piece_count)))
-		for tracker in trackers:
+		for tracker, tracker_config in trackers.items():
 			torrentfile = ".".join(( filename, tracker, "torrent" ))
 			cmd = [ "mktorrent", "-d"]
-			if config[tracker]["dht"] == "disabled":
+			if not tracker_config["dht"]:
 				cmd += [ "-p", "-s", tracker ]
 			cmd += [ "-o", torrentfile, "-l", piece_size ]
-			tiers = sorted([
-				k.split(".")[2]
-				for k in config[tracker].keys()
-				if k.startswith("announce.tier.")
-			], key=int)
-			for tier in tiers:
-				urls = sorted([ k.split(".")[4] for k in config[tracker] if k.startswith("announce.tier." + tier + ".url.") ], key=int)
-				urls = [ config[tracker]["announce.tier." + tier + ".url." + url] for url in urls ]
+			for urls in tracker_config["tiers"]:
 				cmd.append("-a")
 				cmd.append(",".join(urls))
 			cmd.append(filename)
-			print(*[ shlex.quote(arg) for arg in cmd ])
-			result = run(cmd, stdin=DEVNULL, stdout=DEVNULL).returncode
+			if not args.quiet:
+				print(shlex.join(cmd))
+			cmds.append(cmd)
+
+	# Each mktorrent hashes on a single core and the trackers of one file share the page cache
+	returncode = 0
+	with ThreadPoolExecutor(max_workers=max(1, min(len(cmds), os.cpu_count() or 1))) as executor:
+		for result in executor.map(mktorrent, cmds):
 			if returncode == 0 and result != 0:
 				returncode = result
-
 	return returncode
 
+def mktorrent(cmd):
+	return run(cmd, stdin=DEVNULL, stdout=DEVNULL).returncode
+
 if __name__ == "__main__":
 	sys.exit(main(parse_cli()))
@@ -1,21 +1,48 @@
 #!/usr/bin/python3 -O
 # vim: noexpandtab, tabstop=4, number
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, Namespace
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 from configparser import ConfigParser
-from glob import glob
-from hashlib import sha3_224
+from copy import copy
+from functools import cached_property
+from hashlib import sha1, sha3_224
+from itertools import chain
 import json
-from math import ceil, floor, log, sqrt
+from math import ceil, floor, gcd, log, log2, sqrt
 import os
+import pickle
+import re
 import shlex
+from signal import SIGPIPE
+import struct
 from subprocess import run, Popen, DEVNULL, PIPE, CalledProcessError
 import sys
+from tempfile import mkstemp
+from threading import BoundedSemaphore, Lock
+
+try:
+	from orjson import loads as json_loads
+except ImportError:
+	from json import loads as json_loads
+
+def njit(*args, **kwargs): return lambda f: f
+
+# Importing numba alone costs more than next_guess ever will between ffmpeg runs, so it's only used on request
+if os.environ.get("SCREENSHOTS_NUMBA"):
+	try:
+		from numba import njit
+	except ImportError:
+		pass
 
 class VideoMetadata(object):
-	def __init__(self, filename):
+	def __init__(self, filename, need_text=False):
 		self.filename = filename
-		self.text = ffprobe_text(filename)
-		metadata = ffprobe_json(filename)
+		# The montage label is ffprobe's summary, when it's needed anyway ffprobe provides the metadata as well
+		fast = not need_text and os.path.splitext(filename)[1].lower() in MP4_EXTENSIONS
+		metadata = mp4_probe(filename) if fast else None
+		if metadata is None:
+			metadata, self.text = ffprobe(filename)
 		self.metadata = metadata
 		video_streams = [ stream for stream in metadata["streams"] if stream["codec_type"] == "video" ]
 		if not video_streams:
@@ -23,31 +50,26 @@ class VideoMetadata(object):
 		default_video_streams = [ stream for stream in video_streams if stream["disposition"]["default"] == 1 ]
 		self.video_stream = default_video_streams[0] if default_video_streams else video_streams[0]
 		self.format = metadata["format"]
-
-	@property
-	def width(self): return int(self.video_stream["width"])
-	
-	@property
-	def height(self): return int(self.video_stream["height"])
-
-	@property
-	def length(self): return float(self.video_stream.get("duration", self.format.get("duration")))
-
-	@property
-	def frame_rate_str(self): return str(self.video_stream["r_frame_rate"])
-
-	@property
-	def frame_rate_num(self): return int(self.frame_rate_str.split("/")[0])
-
-	@property
-	def frame_rate_den(self): return int(self.frame_rate_str.split("/")[1])
-
-	@property
-	def dt_frame(self): return self.frame_rate_den / self.frame_rate_num
-
-PLAYLIST_FILE = "playlist.txt"
+		self.width = int(self.video_stream["width"])
+		self.height = int(self.video_stream["height"])
+		self.length = float(self.video_stream.get("duration", self.format.get("duration")))
+		self.frame_rate_num, self.frame_rate_den = map(int, str(self.video_stream["r_frame_rate"]).split("/"))
+		self.frame_rate = self.frame_rate_num / self.frame_rate_den
+		self.dt_frame = self.frame_rate_den / self.frame_rate_num
+
+	@cached_property
+	def text(self): return ffprobe(self.filename)[1]
+
+MP4_EXTENSIONS = { ".mp4", ".m4v", ".mov" }
+CLIPS_VIDEO_FILE = "clips.mkv"
+GIF_CLIPS_VIDEO_FILE = "gif_clips.mkv"
 CLIPS_FILE = "clips.gif"
-LABEL_FILE = "label.png"
+QUIET = False
+# Files, dither trials and ffmpeg_mimo batches all run in parallel, this caps the total number of ffmpeg processes
+FFMPEG_SLOTS = BoundedSemaphore(os.cpu_count() or 1)
+# Number of running ffmpeg processes pinned to each core we may use, empty where affinity isn't supported
+CORE_USERS = dict.fromkeys(sorted(os.sched_getaffinity(0)), 0) if hasattr(os, "sched_setaffinity") else {}
+CORE_LOCK = Lock()
 DEFAULT_ARGS = Namespace(
 	frames = 20,
 	file_size_max = "5MB",
@@ -71,6 +93,30 @@ DEFAULT_ARGS = Namespace(
 	montage_time_delta_min = 10
 )
 
+def load_config(filename):
+	# The parsed config is pickled and reused until the file or the defaults change
+	try:
+		st = os.stat(filename)
+		key = ( st.st_mtime_ns, st.st_size, vars(DEFAULT_ARGS) )
+	except FileNotFoundError:
+		key = ( None, None, vars(DEFAULT_ARGS) )
+	try:
+		cache_file = os.path.join(cache_dir(), "screenshots.conf.pkl")
+		with open(cache_file, "rb") as f:
+			cached_key, config = pickle.load(f)
+		if cached_key == key:
+			return config
+	except Exception:
+		# Unpickling a damaged or foreign file can raise nearly anything, the config is just parsed again then
+		pass
+	config = parse_config(filename)
+	try:
+		# The cache is only an optimization, a read-only or missing cache directory must not stop the run
+		write_atomic(os.path.join(cache_dir(), "screenshots.conf.pkl"), pickle.dumps(( key, config )))
+	except OSError:
+		pass
+	return config
+
 def parse_config(filename):
 	configfile = ConfigParser()
 	configfile.read(filename)
@@ -102,7 +148,7 @@ def config_option(configfile, section, option, namespace, name, f=str):
 	setattr(namespace, name, f(configfile.get(section, option, fallback=default_value)))
 
 def parse_cli():
-	config = parse_config(os.path.join(os.environ["HOME"], ".torrentutils", "screenshots.conf"))
+	config = load_config(os.path.join(os.environ["HOME"], ".torrentutils", "screenshots.conf"))
 	parser = ArgumentParser(
 		description="Take screenshots and short clips from a video",
 		formatter_class=ArgumentDefaultsHelpFormatter
@@ -119,6 +165,10 @@ def parse_cli():
 		metavar="SEC",  help="Skip the last part of the source video")
 	group.add_argument("--keep", "-k", action="store_true",
 		help="Keep and reuse temporary files")
+	group.add_argument("--quiet", "-q", action="store_true",
+		help="Do not print the commands being run")
+	group.add_argument("--jobs", "-j", type=int, default=max(1, (os.cpu_count() or 1) // 2),
+		metavar="N", help="Number of files to process in parallel")
 	group.add_argument("--frames","-f", type=int, default=config.frames,
 		metavar="N", help="Number of full size frames")
 	group.add_argument("--file-size-max", type=str, default=config.file_size_max,
@@ -169,94 +219,134 @@ def parse_cli():
 		metavar="COLOR", help="Background color")
 	
 	args = parser.parse_args()
-	args.file_size_max = parse_size(args.file_size_max)
+	try:
+		args.file_size_max = parse_size(args.file_size_max)
+	except ValueError as ex:
+		parser.error(str(ex))
 	return args
 
+SIZE_UNITS = {
+	"KiB": 2**10, "MiB": 2**20, "GiB": 2**30, "TiB": 2**40, "PiB": 2**50, "EiB": 2**60, "ZiB": 2**70, "YiB": 2**80,
+	"kB": 10** 3, "MB": 10** 6, "GB": 10** 9, "TB": 10**12, "PB": 10**15, "EB": 10**18, "ZB": 10**21, "YB": 10**24,
+	"B": 1,
+}
+SIZE_PATTERN = re.compile(r"^\s*(\d+(?:\.\d*)?|\.\d+)\s*(" + "|".join(sorted(SIZE_UNITS, key=len, reverse=True)) + r")?\s*$")
+
 def parse_size(s):
-	units = {
-		"KiB": 2**10, "MiB": 2**20, "GiB": 2**30, "TiB": 2**40, "PiB": 2**50, "EiB": 2**60, "ZiB": 2**70, "YiB": 2**80,
-		"kB": 10** 3, "MB": 10** 6, "GB": 10** 9, "TB": 10**12, "PB": 10**15, "EB": 10**18, "ZB": 10**21, "YB": 10**24,
-	}
-	for k, v in units.items():
-		if s.endswith(k): return float(s[:-len(k)]) * v
-	return float(s[:-1]) if s.endswith("B") else float(s)
+	m = SIZE_PATTERN.match(s)
+	size = float(m.group(1)) * SIZE_UNITS[m.group(2) or "B"] if m else 0
+	# A zero, overflowing or NaN limit would make every size check meaningless
+	if not 0 < size < float("inf"):
+		raise ValueError("Invalid size: " + repr(s))
+	return size
 
 def main(args):
+	global QUIET
+	QUIET = args.quiet
 	returncode = 0
-	prefix = args.prefix
 	fmt = "{}{:0" + str(digits(len(args.files))) + "}-"
-	i = 0
-	for filename in args.files:
-		try:
-			i += 1
-			if len(args.files) > 1:
-				args.prefix = fmt.format(prefix, i)
-			process_video(VideoMetadata(filename), args)
-		except CalledProcessError as ex:
-			returncode += 1
-			sys.stderr.write(ex.stderr.decode(sys.getdefaultencoding()))
-			sys.stdout.write(ex.stdout.decode(sys.getdefaultencoding()))
+	jobs = []
+	for i, filename in enumerate(args.files, 1):
+		file_args = copy(args)
+		if len(args.files) > 1:
+			file_args.prefix = fmt.format(args.prefix, i)
+		jobs.append(( filename, file_args ))
+	# Errors are collected per file and reported in command line order, each under its file name, once all files are done
+	with ThreadPoolExecutor(max_workers=max(1, min(len(jobs), args.jobs))) as executor:
+		errors = list(executor.map(process_file, *zip(*jobs)))
+	for filename, ex in zip(args.files, errors):
+		if ex is None:
+			continue
+		returncode += 1
+		sys.stderr.write(f"{filename}: {ex}\n")
+		if isinstance(ex, CalledProcessError):
+			if ex.stderr:
+				sys.stderr.write(ex.stderr.decode(sys.getdefaultencoding()))
+			if ex.stdout:
+				sys.stdout.write(ex.stdout.decode(sys.getdefaultencoding()))
 	return returncode
 
+def process_file(filename, args):
+	try:
+		process_video(VideoMetadata(filename, args.montage_columns > 0 and args.montage_rows > 0), args)
+	except (CalledProcessError, OSError) as ex:
+		# Unreadable inputs fail like a failed probe used to, the other files still get processed
+		return ex
+	return None
+
 def process_video(video, args):
+	# The outputs don't depend on each other and ffmpeg only reads the source, so all of them are produced
+	# side by side. FFMPEG_SLOTS keeps the total number of ffmpeg processes in check.
+	tasks = []
 	if args.gif_clips > 0:
-		clip_files = prepare_clips(video, args, args.gif_clips, args.gif_length, args.gif_width)
-		create_gif(video, args)
-		cleanup_clips(args, clip_files)
+		tasks.append(create_gif)
 	if args.webp_clips > 0:
-		clip_files = prepare_clips(video, args, args.webp_clips, args.webp_length, args.webp_width)
-		create_webp(video, args)
-		cleanup_clips(args, clip_files)
+		tasks.append(webp_pipeline)
 	if args.frames > 0:
-		create_frames(video, args)
+		tasks.append(create_frames)
 	if args.montage_columns > 0 and args.montage_rows > 0:
-		create_montage(video, args)
+		tasks.append(create_montage)
+	with ThreadPoolExecutor(max_workers=max(1, len(tasks))) as executor:
+		futures = [ executor.submit(task, video, args) for task in tasks ]
+	for future in futures:
+		future.result()
+
+def webp_pipeline(video, args):
+	clip_file = prepare_clips(video, args, args.webp_clips, args.webp_length, args.webp_width)
+	create_webp(video, args)
+	cleanup_clips(args, clip_file)
 
 def digits(n):
-	return ceil(log(n + 1, 10))
+	return len(str(n))
+
+def prepare_clips(video, args, clips, length, width, name=CLIPS_VIDEO_FILE):
+	clip_file = args.prefix + name
+	if not (args.keep and os.path.exists(clip_file)):
+		ffinputs, graph = clip_graph(video, args, clips, length, width)
+		# The source is decoded once, every GIF or WebP pass then reads these small clips. FFV1 decodes far faster
+		# than lossless x265, without the disk usage of rawvideo, which grows with frame rate and aspect ratio.
+		ffmpeg(
+			*ffinputs,
+			"-filter_complex", graph,
+			"-map", "[clips]",
+			"-pix_fmt", "yuv444p",
+			"-codec:v", "ffv1",
+			"-level", "3",
+			clip_file
+		)
+	return clip_file
 
-def prepare_clips(video, args, clips, length, width):
+def clip_graph(video, args, clips, length, width):
+	# One input seeked to the start of each clip, trimmed and concatenated into a single video stream labelled [clips]
 	length_with_cuts = video.length - args.cut_start - args.cut_end
-	clip_files = []
+	frames = round(length * video.frame_rate)
 	ffinputs = []
-	ffoutputs = []
-	with open(args.prefix + PLAYLIST_FILE, "w") as playlist:
-		for i in range(clips):
-			clip_file = f"{args.prefix}clip{i + 1:0{digits(clips)}d}.mkv"
-			clip_files.append(clip_file)
-			if not (args.keep and os.path.exists(clip_file)):
-				ss = args.cut_start + length_with_cuts * (i + 1) / (clips + 1) - length / 2
-				frames = round(length * video.frame_rate_num / video.frame_rate_den)
-				ffinputs.append([ "-ss", str(ss), "-i", video.filename ])
-				ffoutputs.append([
-					"-frames:v", str(frames),
-					"-pix_fmt", "yuv444p",
-					"-filter:v", f"scale={width}:-1,setsar=1",
-					"-codec:v", "libx265",
-					"-preset:v", "ultrafast",
-					"-x265-params", "lossless=1",
-					"-an", "-sn", "-dn",
-					clip_file
-				])
-			playlist.write("file '{}'\n".format(clip_file))
-	ffmpeg_mimo(ffinputs, ffoutputs)
-	return clip_files
+	graph = []
+	for i in range(clips):
+		ss = args.cut_start + length_with_cuts * (i + 1) / (clips + 1) - length / 2
+		ffinputs += [ "-ss", str(ss), "-i", video.filename ]
+		graph.append(f"[{i}:v]trim=end_frame={frames},setpts=PTS-STARTPTS,scale={width}:-1,setsar=1[c{i}]")
+	graph.append("".join(f"[c{i}]" for i in range(clips)) + f"concat=n={clips}:v=1:a=0[clips]")
+	return ffinputs, ";".join(graph)
 
 def create_gif(video, args):
 	depth = args.gif_color_depth_max
-	frame_rate = min(video.frame_rate_num / video.frame_rate_den, args.gif_frame_rate_max)
+	frame_rate = min(video.frame_rate, args.gif_frame_rate_max)
 	multi_palette = True
-	s = choose_dither_algo(depth, frame_rate, multi_palette, args.prefix)
+	# GIF and WebP clips differ in count, length and width and are made concurrently, so each has its own file
+	clip_file = prepare_clips(video, args, args.gif_clips, args.gif_length, args.gif_width, GIF_CLIPS_VIDEO_FILE)
+	s = choose_dither_algo(depth, frame_rate, multi_palette, args.prefix, clip_file)
 	while s > args.file_size_max:
 		r = args.file_size_max / s
 		depth, frame_rate = next_guess(depth, frame_rate, multi_palette, r)
 		if multi_palette and (depth < args.gif_color_depth_min or frame_rate < args.gif_frame_rate_min):
 			depth = args.gif_color_depth_max
-			frame_rate = min(video.frame_rate_num / video.frame_rate_den, args.gif_frame_rate_max)
+			frame_rate = min(video.frame_rate, args.gif_frame_rate_max)
 			multi_palette = False
-		s = choose_dither_algo(depth, frame_rate, multi_palette, args.prefix)
+		s = choose_dither_algo(depth, frame_rate, multi_palette, args.prefix, clip_file)
+	cleanup_clips(args, clip_file)
 
-def choose_dither_algo(depth, frame_rate, multi_palette, prefix):
+def choose_dither_algo(depth, frame_rate, multi_palette, prefix, clip_file):
 	dither_algos = {
 		prefix + "bayer1.gif":			"dither=bayer:bayer_scale=1",
 		prefix + "bayer2.gif":			"dither=bayer:bayer_scale=2",
@@ -266,37 +356,42 @@ def choose_dither_algo(depth, frame_rate, multi_palette, prefix):
 		prefix + "sierra2.gif":			"dither=sierra2",
 		prefix + "sierra2_4a.gif":		"dither=sierra2_4a"
 	}
-	cmd = [ "-f", "concat", "-safe", "0", "-i", prefix + PLAYLIST_FILE ]
-	for name, algo in dither_algos.items():
-		cmd += [ "-filter:v", filter_v(depth, frame_rate, algo, multi_palette), name ]
-	ffmpeg(*cmd)
-	best = None
-	for name, algo in dither_algos.items():
-		current = ( name, algo, os.stat(name).st_size )
-		if not best:
-			best = current
-		elif current[2] <= best[2]:
-			os.unlink(best[0])
-			best = current
-		else:
-			os.unlink(current[0])
-	os.rename(best[0], prefix + CLIPS_FILE)
-	return best[2]
-
-def filter_v(depth, frame_rate, dither_algo, multi_palette):
-	fmt = "fps={},split[a][b],[a]fifo[c],[b]palettegen=max_colors={}:{}:{}[p],[c][p]paletteuse={}:{}"
+	# Decode the clips and generate the palette once, then fan both out to one paletteuse per algorithm
+	ffmpeg(
+		"-i", clip_file,
+		"-filter_complex", dither_graph(depth, frame_rate, multi_palette, dither_algos.values()),
+		*chain.from_iterable([ "-map", f"[o{i}]", name ] for i, name in enumerate(dither_algos))
+	)
+	sizes = file_sizes(prefix, dither_algos)
+	best = min(dither_algos, key=sizes.get)
+	for name in dither_algos:
+		if name != best:
+			os.unlink(name)
+	os.rename(best, prefix + CLIPS_FILE)
+	return sizes[best]
+
+def dither_graph(depth, frame_rate, multi_palette, dither_algos):
 	stats_mode = "stats_mode=single" if multi_palette else "stats_mode=diff"
 	transparent = "reserve_transparent=0" if multi_palette else "reserve_transparent=1"
 	new = "new=1" if multi_palette else "new=0"
-	return fmt.format(frame_rate, depth, stats_mode, transparent, dither_algo, new)
-
+	n = len(dither_algos)
+	graph = [
+		f"[0:v]fps={frame_rate},split[a][b]",
+		f"[a]fifo,split={n}" + "".join(f"[v{i}]" for i in range(n)),
+		f"[b]palettegen=max_colors={depth}:{stats_mode}:{transparent},split={n}" + "".join(f"[p{i}]" for i in range(n)),
+	]
+	graph += [ f"[v{i}][p{i}]paletteuse={algo}:{new}[o{i}]" for i, algo in enumerate(dither_algos) ]
+	return ";".join(graph)
+
+@njit(cache=True)
 def next_guess(depth, frame_rate, multi_palette, r):
 	if multi_palette:
-		new_depth = depth // 2
-		new_frame_rate = log(depth, 2) * frame_rate * r / log(new_depth, 2)
-		while new_frame_rate > frame_rate:
-			new_depth = (new_depth + depth) // 2
-			new_frame_rate = log(depth, 2) * frame_rate * r / log(new_depth, 2)
+		# Size is modelled as frame_rate * log2(depth), so the frame rate does not grow as long as
+		# log2(new_depth) >= log2(depth) * r. Halve the depth if possible, else take the smallest depth that works.
+		bits = log2(depth)
+		new_depth = max(depth // 2, ceil(2 ** (bits * r)))
+		new_frame_rate = bits * frame_rate * r / log2(new_depth)
+		assert new_frame_rate <= frame_rate * (1 + 1e-9)
 		return (new_depth, new_frame_rate)
 	else:
 		# TODO: This always underestimates the size, leading to several passes in single palette mode. It's because the
@@ -308,12 +403,10 @@ def create_webp(video, args):
 	size_factor = 1.05 # TODO: learn & store size factor
 	size = None
 	quality = 95
-	print(unique_id(args.prefix))
+	print(f"{unique_id(args.prefix)}  {video.filename}")
 	while size == None or args.file_size_max < size:
 		ffmpeg(
-			"-f", "concat",
-			"-safe", "0",
-			"-i", args.prefix + PLAYLIST_FILE,
+			"-i", args.prefix + CLIPS_VIDEO_FILE,
 			"-c:v", "libwebp",
 			"-loop", "0",
 			"-compression_level", "6",
@@ -325,9 +418,7 @@ def create_webp(video, args):
 
 def unique_id(prefix):
 	process = ffmpeg_popen(
-		"-f", "concat",
-		"-safe", "0",
-		"-i", prefix + PLAYLIST_FILE,
+		"-i", prefix + CLIPS_VIDEO_FILE,
 		"-codec:v", "yuv4",
 		"-f", "rawvideo",
 		"-"
@@ -345,32 +436,54 @@ def unique_id(prefix):
 	return hash_state.hexdigest()
 	
 
-def cleanup_clips(args, clip_files):
+def cleanup_clips(args, clip_file):
 	if not args.keep:
-		for f in clip_files:
-			os.unlink(f)
-		os.unlink(args.prefix + PLAYLIST_FILE)
+		os.unlink(clip_file)
 
 def create_frames(video, args):
 	length_with_cuts = video.length - args.cut_start - args.cut_end
 	dt_large = length_with_cuts / (args.frames + 1)
 	timestamps = [ args.cut_start + (i + 1) * dt_large for i in range(args.frames) ]
+	d = digits(args.frames)
+	names = [ f"{args.prefix}frame{i + 1:0{d}d}.png" for i in range(args.frames) ]
+	# Frames of an earlier run with another frame count or JPEG fallbacks would otherwise be mixed in
+	remove_numbered(args.prefix + "frame", ".png", ".jpg")
 	ffmpeg_mimo(
-		[ [ "-ss", str(t), "-to", str(t + video.dt_frame), "-i", video.filename ] for t in timestamps ],
-		[ [ "-frames:v", "1", f"{args.prefix}frame{i + 1:0{digits(args.frames)}d}.png" ] for i in range(args.frames) ]
+		seek_inputs(video, timestamps),
+		[ [ "-frames:v", "1", "-compression_level", "9", "-pred", "mixed", name ] for name in names ]
 	)
-	for i in range(args.frames):
-		filename = f"{args.prefix}frame{i + 1:0{digits(args.frames)}d}.png"
-		if os.stat(filename).st_size > args.file_size_max:
-			os.unlink(filename)
+	sizes = file_sizes(args.prefix, names)
+	# Frames too large as PNG are retried as JPEG, raising the quantizer by how far each one is over the limit
+	retries = [ (t, name[:-len(".png")] + ".jpg", 2) for t, name in zip(timestamps, names) if sizes[name] > args.file_size_max ]
+	for name in names:
+		if sizes[name] > args.file_size_max:
+			os.unlink(name)
+	while retries:
+		ffmpeg_mimo(
+			seek_inputs(video, [ t for t, _, _ in retries ]),
+			[ [ "-frames:v", "1", "-q:v", str(q), name ] for _, name, q in retries ]
+		)
+		sizes = file_sizes(args.prefix, [ name for _, name, _ in retries ])
+		oversize = [ (t, name, q) for t, name, q in retries if sizes[name] > args.file_size_max ]
+		for _, name, _ in oversize:
+			os.unlink(name)
+		retries = [ (t, name, min(ceil(q * sizes[name] / args.file_size_max), 31)) for t, name, q in oversize if q < 31 ]
+
+def seek_inputs(video, timestamps):
+	# One single frame input per timestamp. Seeking stays accurate: snapping to the keyframe before each timestamp
+	# would give identical frames for all timestamps within one GOP, and frames that don't match their label.
+	ends = map(str, [ t + video.dt_frame for t in timestamps ])
+	return [ [ "-ss", ss, "-to", to, "-i", video.filename ] for ss, to in zip(map(str, timestamps), ends) ]
 
 def create_montage(video, args):
 	rows = min(max(floor(video.length / (args.montage_time_delta_min * args.montage_columns)), 1), args.montage_rows)
 	cells = args.montage_columns * rows
 	dt_cell = video.length / (cells + 1)
 	timestamps = [ (i + 1) * dt_cell for i in range(cells) ]
+	d = digits(cells)
+	names = [ f"{args.prefix}montage{i:0{d}d}.png" for i in range(cells) ]
 	ffmpeg_mimo(
-		[ [ "-ss", str(t), "-to", str(t + video.dt_frame), "-i", video.filename ] for t in timestamps ],
+		seek_inputs(video, timestamps),
 		[
 			[
 				"-filter:v", ",".join([
@@ -379,27 +492,39 @@ def create_montage(video, args):
 					f"drawtext=text=%{{pts\\\:hms}}:fontfile={args.font_file}:fontsize={args.font_size}:x=4:y=4:shadowx=-2:shadowy=-2:fontcolor={args.font_color}:shadowcolor={args.font_background}",
 				]),
 				"-frames:v", "1",
-				f"{args.prefix}montage{i:0{digits(cells)}d}.png"
+				name
 			]
-			for i in range(cells)
+			for i, name in enumerate(names)
 		]
 	)
-	montage(f"{args.prefix}montage.png", args.montage_columns, rows, [ f"{args.prefix}montage{i:0{digits(cells)}d}.png" for i in range(cells) ])
-	create_label(video, args)
-	append_label(f"{args.prefix}montage.jpg", args.prefix + LABEL_FILE, f"{args.prefix}montage.png")
-	append_label(f"{args.prefix}montage.webp", args.prefix + LABEL_FILE, f"{args.prefix}montage.png")
+	labelled_montage(video, args, rows, names, [ f"{args.prefix}montage.jpg", f"{args.prefix}montage.webp" ])
 	if os.stat(f"{args.prefix}montage.jpg").st_size <= os.stat(f"{args.prefix}montage.webp").st_size:
 		os.unlink(f"{args.prefix}montage.webp")
-	for i in range(cells):
-		os.unlink(f"{args.prefix}montage{i:0{digits(cells)}d}.png")
-	os.unlink(f"{args.prefix}montage.png")
-	os.unlink(args.prefix + LABEL_FILE)
-
-def montage(outfile, columns, rows, infiles):
-	echo_and_run([ "montage", "-geometry", "+0+0", "-tile", f"{columns}x{rows}" ] + infiles + [ outfile ], stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
-
-def create_label(video, args):
-	proc = run([
+	remove_numbered(args.prefix + "montage", ".png")
+
+def file_sizes(prefix, names):
+	# All names start with prefix, so one scan of its directory finds them
+	wanted = { os.path.basename(name): name for name in names }
+	with os.scandir(os.path.dirname(prefix) or ".") as entries:
+		sizes = { wanted[entry.name]: entry.stat().st_size for entry in entries if entry.name in wanted }
+	missing = wanted.keys() - { os.path.basename(name) for name in sizes }
+	if missing:
+		raise FileNotFoundError("Missing output: " + ", ".join(sorted(missing)))
+	return sizes
+
+def remove_numbered(prefix, *suffixes):
+	# Removes prefix + digits + suffix files with one directory scan, e.g. montage cells but not montage.png itself
+	directory, base = os.path.split(prefix)
+	with os.scandir(directory or ".") as entries:
+		for entry in entries:
+			stem, suffix = os.path.splitext(entry.name)
+			if suffix in suffixes and stem.startswith(base) and stem[len(base):].isdigit():
+				os.unlink(entry.path)
+
+def labelled_montage(video, args, rows, infiles, outfiles):
+	# montage streams the tiled cells to convert, which renders the label on top and writes every output format
+	tiles_cmd = [ "montage", "-geometry", "+0+0", "-tile", f"{args.montage_columns}x{rows}" ] + infiles + [ "miff:-" ]
+	label_cmd = [
 		"convert",
 		"-background", args.font_background,
 		"-fill", args.font_color,
@@ -407,69 +532,250 @@ def create_label(video, args):
 		"-pointsize", str(args.font_size),
 		"-size", str(args.montage_columns * args.montage_cell_width) + "x",
 		"caption:" + video.text,
-		args.prefix + LABEL_FILE
-	], stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
-	proc.check_returncode()
-
-def append_label(outfile, *args):
-	echo_and_run([
-		"convert",
-		"-quality", "95",
+		"+size", "miff:-",
 		"-background", "black",
-		"-append"
-	] + list(args) + [ outfile ], stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
-
-def ffmpeg_mimo(inputs, outputs, limit=10):
+		"-append",
+		"-quality", "95",
+		*chain.from_iterable([ "-write", outfile ] for outfile in outfiles[:-1]),
+		outfiles[-1]
+	]
+	if not QUIET:
+		print(shlex.join(tiles_cmd), "|", shlex.join(label_cmd))
+	tiles = Popen(tiles_cmd, stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
+	label = Popen(label_cmd, stdin=tiles.stdout, stdout=DEVNULL, stderr=PIPE)
+	tiles.stdout.close()
+	# Drain both stderr pipes at the same time so that neither process can stall the other
+	with ThreadPoolExecutor(max_workers=2) as executor:
+		futures = [ executor.submit(wait_checked, proc) for proc in ( tiles, label ) ]
+	tiles_error, label_error = [ future.exception() for future in futures ]
+	# montage dies of SIGPIPE when convert fails early, convert's own error is the one worth reporting then
+	if tiles_error and not (label_error and getattr(tiles_error, "returncode", None) == -SIGPIPE):
+		raise tiles_error
+	if label_error:
+		raise label_error
+
+def ffmpeg_mimo(inputs, outputs, limit=10, max_workers=None):
 	assert len(inputs) == len(outputs)
-	# Process `limit` inputs at a time to limit memory usage
-	N = len(inputs) // limit
-	M = len(inputs) % limit
-	for i in range(N):
-		a = i * limit
-		b = a + limit
-		ffmpeg(
-			"-vsync", "passthrough",
-			*flatten(inputs[a:b]),
-			*flatten([ [ "-map", f"{j}:v" ] + out for j, out in zip(range(limit), outputs[a:b]) ])
-		)
-	if M != 0:
-		a = N * limit
-		b = a + M
-		ffmpeg(
-			"-vsync", "passthrough",
-			*flatten(inputs[a:b]),
-			*flatten([ [ "-map", f"{j}:v" ] + out for j, out in zip(range(M), outputs[a:b]) ])
-		)
-
-def flatten(list_of_lists):
-	return [val for sublist in list_of_lists for val in sublist]
-
-def ffmpeg(*args):
-	echo_and_run(( "ffmpeg", "-y", "-hide_banner" ) + args, stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
-
-def echo_and_run(args, **kwargs):
-	print(" ".join([ shlex.quote(arg) for arg in args ]))
-	proc = run(args, stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
-	proc.check_returncode()
+	if not inputs:
+		return
+	# Process `limit` inputs per ffmpeg process to limit memory usage, and run the batches concurrently
+	batches = ceil(len(inputs) / limit)
+	if max_workers is None:
+		max_workers = min(os.cpu_count() or 1, batches)
+	threads = max(1, (os.cpu_count() or 1) // max_workers)
+	# -threads is a per file option, so every decoder and encoder of a batch gets its own
+	limits = [ "-threads", str(threads) ]
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		futures = []
+		for i in range(batches):
+			a = i * limit
+			b = a + limit
+			futures.append(executor.submit(
+				ffmpeg,
+				"-vsync", "passthrough",
+				"-filter_threads", str(threads),
+				*chain.from_iterable(limits + inp for inp in inputs[a:b]),
+				*chain.from_iterable([ "-map", f"{j}:v" ] + limits + out for j, out in enumerate(outputs[a:b])),
+				threads=threads
+			))
+		wait(futures)
+	for future in futures:
+		future.result()
+
+def ffmpeg(*args, threads=None):
+	# Callers running several ffmpeg processes at once limit the -threads of each input and output themselves and
+	# pass that limit as `threads`. The process is then pinned to that many of the least busy cores. Only ffmpeg_mimo
+	# batches do this, the single GIF and WebP processes are left to the scheduler and may run on any core.
+	with FFMPEG_SLOTS:
+		cores = claim_cores(threads) if threads is not None else []
+		try:
+			echo_and_run(( "ffmpeg", "-y", "-hide_banner", "-nostats" ) + args, cores)
+		finally:
+			release_cores(cores)
+
+def claim_cores(n):
+	with CORE_LOCK:
+		cores = sorted(CORE_USERS, key=CORE_USERS.get)[:n]
+		for core in cores:
+			CORE_USERS[core] += 1
+	return cores
+
+def release_cores(cores):
+	with CORE_LOCK:
+		for core in cores:
+			CORE_USERS[core] -= 1
+
+def echo_and_run(args, cores=None):
+	if not QUIET:
+		print(shlex.join(args))
+	run_checked(args, cores=cores)
+
+def run_checked(args, capture=False, cores=None):
+	# Only ffprobe needs the output, everything else just streams stderr for error reporting
+	if capture:
+		proc = run(args, stdin=DEVNULL, capture_output=True)
+		proc.check_returncode()
+		return proc.stdout, proc.stderr
+	proc = Popen(args, stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE)
+	if cores:
+		# Set from here rather than in preexec_fn, which isn't safe with threads. ffmpeg starts its worker
+		# threads only after parsing its arguments, and those inherit the mask. Pinning is only a hint, the
+		# process must be waited for even if it already exited or the mask is refused.
+		try:
+			os.sched_setaffinity(proc.pid, cores)
+		except OSError:
+			pass
+	wait_checked(proc)
+
+def wait_checked(proc):
+	# Only the end of stderr is kept for error reporting, the rest is read and dropped as it arrives
+	tail = deque(maxlen=16)
+	with proc:
+		for block in iter(lambda: proc.stderr.read(2**12), b""):
+			tail.append(block)
+	if proc.returncode != 0:
+		raise CalledProcessError(proc.returncode, proc.args, b"", b"".join(tail))
 
 def ffmpeg_popen(*args):
 	return Popen(( "ffmpeg", "-y", "-hide_banner" ) + args, stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL)
 
-def ffprobe_json(filename):
-	proc = run(
+def ffprobe(filename):
+	st = os.stat(filename)
+	path = os.path.abspath(filename)
+	key = sha1(repr(( path, st.st_mtime_ns, st.st_size )).encode()).hexdigest()
+	try:
+		with open(os.path.join(cache_dir("ffprobe"), key + ".json"), "rb") as f:
+			cached = json_loads(f.read())
+		# Anything not shaped like an entry written below is treated as a miss and probed again
+		if isinstance(cached["json"], dict) and isinstance(cached["text"], str):
+			return cached["json"], cached["text"]
+	except (OSError, ValueError, KeyError, TypeError):
+		pass
+	metadata, text = run_ffprobe(filename)
+	try:
+		write_atomic(os.path.join(cache_dir("ffprobe"), key + ".json"), json.dumps({ "path": path, "json": metadata, "text": text }).encode())
+	except OSError:
+		pass
+	return metadata, text
+
+def cache_dir(*names):
+	path = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.environ["HOME"], ".cache"), "torrentutils", *names)
+	os.makedirs(path, exist_ok=True)
+	return path
+
+def write_atomic(filename, data):
+	# Concurrent runs may write the same cache entry, readers must never see a partial file
+	fd, tmp = mkstemp(dir=os.path.dirname(filename))
+	try:
+		with os.fdopen(fd, "wb") as f:
+			f.write(data)
+		os.replace(tmp, filename)
+	except BaseException:
+		os.unlink(tmp)
+		raise
+
+def run_ffprobe(filename):
+	# The JSON goes to stdout while the human readable summary is still printed to stderr
+	stdout, stderr = run_checked(
 		[ "ffprobe", "-hide_banner", "-print_format", "json", "-show_format", "-show_streams", filename ],
-		stdin=DEVNULL, stdout=PIPE, stderr=PIPE
+		capture=True
 	)
-	proc.check_returncode()
-	return json.loads(proc.stdout.decode(sys.getdefaultencoding()))
-
-def ffprobe_text(filename):
-	proc = run(
-		[ "ffprobe", "-hide_banner", filename ],
-		stdin=DEVNULL, stdout=PIPE, stderr=PIPE
-	)
-	proc.check_returncode()
-	return proc.stderr.decode(sys.getdefaultencoding()).strip()
+	return json_loads(stdout), stderr.decode(sys.getdefaultencoding()).strip()
+
+def mp4_probe(filename):
+	# Reads the few fields VideoMetadata needs straight from the moov box, shaped like ffprobe's JSON.
+	# Anything unusual (fragmented, compressed moov, variable frame rate...) returns None to fall back to ffprobe.
+	try:
+		with open(filename, "rb") as f:
+			moov = mp4_read_box(f, b"moov")
+		if moov is None:
+			return None
+		duration = None
+		streams = []
+		for kind, box in mp4_boxes(moov):
+			if kind == b"mvhd":
+				timescale, units = mp4_times(box)
+				duration = units / timescale
+			elif kind == b"trak":
+				stream = mp4_video_stream(box)
+				if stream:
+					streams.append(stream)
+		if duration is None or not streams:
+			return None
+		return { "streams": streams, "format": { "duration": str(duration) } }
+	except (struct.error, IndexError, KeyError, ValueError, ZeroDivisionError):
+		return None
+
+def mp4_read_box(f, wanted):
+	while True:
+		header = f.read(8)
+		if len(header) < 8:
+			return None
+		size, kind = struct.unpack(">I4s", header)
+		if size == 1:
+			size = struct.unpack(">Q", f.read(8))[0] - 16
+		elif size == 0:
+			size = -1
+		else:
+			size -= 8
+		if kind == wanted:
+			return memoryview(f.read(size))
+		if size < 0:
+			return None
+		f.seek(size, os.SEEK_CUR)
+
+def mp4_boxes(data):
+	offset = 0
+	while offset + 8 <= len(data):
+		size, kind = struct.unpack_from(">I4s", data, offset)
+		header = 8
+		if size == 1:
+			size = struct.unpack_from(">Q", data, offset + 8)[0]
+			header = 16
+		elif size == 0:
+			size = len(data) - offset
+		if size < header:
+			raise ValueError("Invalid MP4 box size")
+		yield kind, data[offset + header:offset + size]
+		offset += size
+
+def mp4_children(data):
+	children = {}
+	for kind, box in mp4_boxes(data):
+		children.setdefault(kind, box)
+	return children
+
+def mp4_times(box):
+	# mvhd and mdhd: version, flags, creation and modification times, then timescale and duration
+	if box[0] == 1:
+		return struct.unpack_from(">IQ", box, 20)
+	return struct.unpack_from(">II", box, 12)
+
+def mp4_video_stream(trak):
+	trak = mp4_children(trak)
+	mdia = mp4_children(trak[b"mdia"])
+	if mdia[b"hdlr"][8:12] != b"vide":
+		return None
+	timescale, units = mp4_times(mdia[b"mdhd"])
+	stbl = mp4_children(mp4_children(mdia[b"minf"])[b"stbl"])
+	# Width and height sit 32 bytes into the first (visual) sample entry of stsd
+	width, height = struct.unpack_from(">HH", stbl[b"stsd"], 40)
+	entries, = struct.unpack_from(">I", stbl[b"stts"], 4)
+	if entries != 1:
+		raise ValueError("Variable frame rate")
+	delta = struct.unpack_from(">II", stbl[b"stts"], 8)[1]
+	if timescale == 0 or delta == 0:
+		raise ValueError("Invalid frame duration")
+	d = gcd(timescale, delta)
+	flags = int.from_bytes(trak[b"tkhd"][1:4], "big")
+	return {
+		"codec_type": "video",
+		"width": width,
+		"height": height,
+		"r_frame_rate": f"{timescale // d}/{delta // d}",
+		"duration": str(units / timescale),
+		"disposition": { "default": 1 if flags & 1 else 0 }
+	}
 
 if __name__ == "__main__":
 	sys.exit(main(parse_cli()))